@@ -1,5 +1,32 @@
-import json
-import urllib2
+from concurrent.futures import ThreadPoolExecutor
+import re
+import threading
+import time
+from typing import Any, List
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    try:
+        from ujson import loads as _loads
+    except ImportError:
+        from json import loads as _loads
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DATA_TYPES = frozenset(('val', 'txt'))
+UNSUPPORTED_DATA_TYPES = frozenset(('image', 'layer'))
+WX_TYPES = frozenset(('wxfcs', 'wxobs'))
+
 
 class DPRequest(object):
 
@@ -46,9 +73,6 @@ class DPRequest(object):
         translate text-based data.
 
     """
-    data_types = ['val', 'txt']
-    unsupported_data_types = ['image', 'layer']
-    wx_types = ['wxfcs', 'wxobs']
     request_types = {
         'fcs_sites': 'val/wxfcs/all/{}/sitelist',
         'fcs_capabilities': 'val/wxfcs/all/{}/capabilities',
@@ -67,11 +91,33 @@ class DPRequest(object):
         'mountains_sitelist': 'txt/wxfcs/mountainarea/{}/sitelist',
         'mountains_capabilities': 'txt/wxfcs/mountainarea/{}/capabilities',
         'mountain_specific': 'txt/wxfcs/mountainarea/{}/{}'}
+    # The request types pre-split into their fixed resource fragments and
+    # their (wx, common type) names, so common requests need no formatting.
+    _request_parts = {k: tuple(v.split('{}'))
+                      for k, v in request_types.items()}
+    _request_meta = {k: tuple(k.split('_')) for k in request_types}
+    _valid_request_types = frozenset(request_types)
+    # A single HTTP session shared by all instances, so that successive
+    # requests to DataPoint reuse pooled keep-alive connections.
+    _session = None
+    # Responses shared between instances, keyed by request string, as
+    # (expiry time, response, parsed data). Capabilities and sitelists change
+    # rarely, so are kept for longer than the data itself.
+    _cache = {}
+    _cache_lock = threading.Lock()
+    _cache_size = 256
+    _cache_ttl = 300
+    _long_lived_ttl = 3600
+    _long_lived = re.compile(r'/(capabilities|sitelist)\?')
+    # Per-thread simdjson parsers, reused so that their buffers are recycled.
+    _parsers = threading.local()
+    # msgspec SiteRep types, keyed by the single Rep field that each decodes.
+    _site_rep_types = {}
 
 
     def __init__(self, data_type, wx_type, api_key,
                  request_type=None, time_period='all', site_id='all',
-                 **kwargs):
+                 verbose=False, **kwargs):
         """
         Define the variables to compose the query to DataPoint.
 
@@ -87,11 +133,14 @@ class DPRequest(object):
               capabilities request to determine valid time periods.
             * site_id: the ID of an observing/forecast site or 'all' (default).
               Use the sitelist request to determine valid sites.
+            * verbose: if True, print each query string as it is requested.
+              Defaults to False.
             * **kwargs: other keyword args, for specific keyword queries. For
               example:
 
                   * res: the temporal resolution of the data requested; an
-                    integer value or `None` (default).
+                    integer number of hours, a string such as 'hourly', or
+                    `None` (default).
                   * query_time: to request data for a specific time; a string
                     of format yyyy-mm-ddThhZ or `None` (default).
 
@@ -102,40 +151,115 @@ class DPRequest(object):
             * data_container: the fixed data container format (json). Fixed
               to keep the code simple so that only one format need be parsed.
             * request_str: base_url, but populated.
-            * response: the response from the server: a json-formatted string
-              or error code.
+            * response: the raw bytes of the json-formatted response from the
+              server. These are passed directly to the JSON parser, without
+              first being decoded.
             * data: the json data in `self.response` converted to a Pythonic
               data structure.
 
         """
+        if data_type in UNSUPPORTED_DATA_TYPES:
+            raise NotImplementedError('Data type {} is not supported'.format(
+                data_type))
+        if data_type not in DATA_TYPES:
+            raise ValueError('Data type {} is not valid; valid options: '
+                             '{}'.format(data_type, sorted(DATA_TYPES)))
+        if wx_type not in WX_TYPES:
+            raise ValueError('Weather type {} is not valid; valid options: '
+                             '{}'.format(wx_type, sorted(WX_TYPES)))
         self.data_type = data_type
         self.wx_type = wx_type
         self.api_key = api_key
         self.time_period = time_period
         self.site_id = site_id
+        self.verbose = verbose
         self.kwargs = kwargs
         self.base_url = 'http://datapoint.metoffice.gov.uk/public/data/{}?{}key={}'
+        # The fixed fragments of `base_url`, so that the resource, query and
+        # API key can be filled in by concatenation.
+        url_parts = self.base_url.split('{}')
+        self._url_head, self._url_mid, self._url_tail = url_parts[:3]
         self.data_container = 'json'
         self.request_str = None
         self.http_code = None
         self.response = None
         self.data = None
+        if DPRequest._session is None:
+            DPRequest._session = self._make_session()
 
-    def _request(self):
+    @staticmethod
+    def _make_session():
         """
-        Uses urllib2 to send the request and read the result. Catches http
-        errors (response code != 200).
+        Creates the shared HTTP session, with a connection pool and retries
+        on transient connection failures.
 
         """
-        if self.request_str is not None:
-            try:
-                resp = urllib2.urlopen(self.request_str)
-                self.response = resp.read()
-            except urllib2.HTTPError:
-                raise
-        else:
+        session = requests.Session()
+        # requests already asks for compressed responses (gzip and deflate,
+        # and brotli or zstandard where available) and decompresses them into
+        # `Response.content`, so no Accept-Encoding header is set here.
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=20,
+                              max_retries=Retry(total=3, backoff_factor=0.3))
+        session.mount('http://', adapter)
+        return session
+
+    def _request(self, use_cache=True):
+        """
+        Uses the shared HTTP session to send the request and read the result.
+        Raises an HTTPError for client or server errors (response codes
+        4xx and 5xx).
+
+        A recent response to the same request string is reused from the
+        response cache rather than requested again, unless `use_cache` is
+        False. The fresh response is cached in either case.
+
+        """
+        if self.request_str is None:
             raise ValueError('Request string has not been set.')
 
+        now = time.time()
+        cached = None
+        if use_cache:
+            with self._cache_lock:
+                cached = self._cache.get(self.request_str)
+        if cached is not None and cached[0] > now:
+            _, self.response, self.data = cached
+            return
+
+        resp = self._session.get(self.request_str, timeout=30)
+        resp.raise_for_status()
+        self.response = resp.content
+        self.data = None
+
+        if self._long_lived.search(self.request_str):
+            expiry = now + self._long_lived_ttl
+        else:
+            expiry = now + self._cache_ttl
+        self._cache_store(self.request_str, (expiry, self.response, None))
+
+    @classmethod
+    def _cache_store(cls, key, entry):
+        """Adds an entry to the response cache, evicting if it is full."""
+        cache = cls._cache
+        with cls._cache_lock:
+            if key not in cache and len(cache) >= cls._cache_size:
+                now = time.time()
+                for stale in [k for k, v in cache.items() if v[0] <= now]:
+                    del cache[stale]
+                if len(cache) >= cls._cache_size:
+                    cache.pop(next(iter(cache)))
+            cache[key] = entry
+
+    @classmethod
+    def clear_cache(cls):
+        """
+        Empties the response cache shared by all instances, so that
+        subsequent requests fetch fresh data from DataPoint.
+
+        """
+        with cls._cache_lock:
+            cls._cache.clear()
+
     def query_string(self):
         """Prints the instance's query string."""
 
@@ -144,7 +268,7 @@ class DPRequest(object):
         else:
             return self.request_str
 
-    def common_requests(self, request_type):
+    def common_requests(self, request_type, fetch=True, use_cache=True):
         """
         DataPoint defines a number of 'common' requests, for example the
         get capabilities and get sitelist requests. This function simplifies
@@ -154,32 +278,30 @@ class DPRequest(object):
         Arg:
             * request_type: a common request type or None (default).
 
+        Keyword arg:
+            * fetch, use_cache: passed to :func:build_request.
+
         """
-        if self.data_type in self.data_types:
-            c_keys = self.request_types.keys()
-        else:
-            raise NotImplementedError('Data type {} is not supported'.format(
-                self.data_type))
-
-        if request_type in c_keys:
-            wx, common_type = request_type.split('_')
-            args = [self.data_container, self.site_id]
-            if common_type == 'fiveday' and self.site_id == 'all':
-                raise ValueError('Location ID cannot equal \'all\' for a '
-                                 'five-day {} request'.format(wx))
-#             elif common_type == 'fiveday':
-#                 resource = self.request_types[
-#                     request_type].format(self.data_container, self.locn_id)
-            else:
-                resource = self.request_types[request_type].format(*args)
+        if request_type not in self._valid_request_types:
+            raise ValueError('Request type supplied does not match to the '
+                             'following valid options:\n  {}'.format(
+                                 sorted(self._valid_request_types)))
+
+        wx, common_type = self._request_meta[request_type]
+        parts = self._request_parts[request_type]
+        if common_type == 'fiveday' and self.site_id == 'all':
+            raise ValueError('Location ID cannot equal \'all\' for a '
+                             'five-day {} request'.format(wx))
+        elif len(parts) == 2:
+            resource = parts[0] + self.data_container + parts[1]
         else:
-            raise NotImplementedError('Request type supplied does not match '
-                                      'to the following valid '
-                                      'options:\n{}'.format(c_keys))
+            resource = (parts[0] + self.data_container + parts[1] +
+                        str(self.site_id) + parts[2])
 
-        self.build_request(resource=resource)
+        self.build_request(resource=resource, fetch=fetch,
+                           use_cache=use_cache)
 
-    def build_request(self, resource=None):
+    def build_request(self, resource=None, fetch=True, use_cache=True):
         """
         Builds the query string from the base string and input variables,
         notably the following elements:
@@ -190,31 +312,49 @@ class DPRequest(object):
         Keyword arg:
             * resource: interface for :func:common_requests. If specified, this
               overrides this function's resource string builder.
+            * fetch: if True (default), send the request immediately. Set to
+              False to only build the query string, for example to send many
+              requests together with :func:fetch_many.
+            * use_cache: if True (default), reuse a recent response to the
+              same request from the response cache. Set to False to always
+              request fresh data from DataPoint.
 
         """
         if resource is None:
-            resource = '{}/{}/{}/{}/{}'.format(self.data_type,
-                                               self.wx_type,
-                                               self.time_period,
-                                               self.data_container,
-                                               self.site_id)
-
-        # Add a keyword query for each specified **kw:
-        sub_query = '{}{}{}{}'
-        query = ''
-        for kw, val in self.kwargs.iteritems():
-            if kw == 'res' and isinstance(val, int):
-                query_end = 'hourly&'
-            else:
-                query_end = '&'
-            query += sub_query.format(kw, '=', val, query_end)
+            resource = '/'.join((self.data_type, self.wx_type,
+                                 str(self.time_period), self.data_container,
+                                 str(self.site_id)))
+
+        # Add a keyword query for each specified **kw, in sorted order so
+        # that equivalent requests share the same (cacheable) query string:
+        kwargs = self.kwargs
+        if kwargs:
+            # An integer temporal resolution is given in the query as
+            # `<n>hourly`.
+            res = kwargs.get('res')
+            if isinstance(res, int):
+                kwargs = dict(kwargs, res='{}hourly'.format(res))
+            parts = []
+            append = parts.append
+            for kw in sorted(kwargs):
+                append(kw)
+                append('=')
+                append(str(kwargs[kw]))
+                append('&')
+            query = ''.join(parts)
+        else:
+            query = ''
 
-        self.request_str = self.base_url.format(resource,
-                                                query,
-                                                self.api_key)
-        print self.request_str
-        print 'Requesting data, please wait...'
-        self._request()
+        self.request_str = (self._url_head + resource + self._url_mid +
+                            query + self._url_tail + self.api_key)
+        # Any previous response belongs to a previous request string.
+        self.response = None
+        self.data = None
+        if fetch:
+            if self.verbose:
+                print(self.request_str)
+                print('Requesting data, please wait...')
+            self._request(use_cache=use_cache)
 
     def parse_response(self):
         """
@@ -224,13 +364,147 @@ class DPRequest(object):
         :Note:
 
             As the JSON spec requires unicode strings, the parsed response
-            will likewise be comprised of unicode strings.
+            will likewise be comprised of (unicode) `str` strings.
+
+            The parsed response is cached, so repeated calls do not re-parse
+            the same response. It is also shared, through the response cache,
+            with other instances making the same request: copy it (for
+            example with `copy.deepcopy`) before modifying it in place. Use
+            `build_request(use_cache=False)` or :func:clear_cache to fetch
+            fresh data instead.
 
         """
+        if self.data is not None:
+            return self.data
         if self.response is None:
             if self.request_str is not None:
                 self._request()
             else:
                 raise ValueError('Request string has not been defined.')
-        self.data = json.loads(self.response)
+            # A cached response may come with its parsed data.
+            if self.data is not None:
+                return self.data
+        self.data = _loads(self.response)
+        with self._cache_lock:
+            cached = self._cache.get(self.request_str)
+            if cached is not None and cached[1] is self.response:
+                self._cache[self.request_str] = (cached[0], cached[1],
+                                                 self.data)
         return self.data
+
+    def rep_values(self, field, dtype=None):
+        """
+        Returns the value of `field` from each Rep of each Period in a
+        SiteRep response; for example, 'P' to retrieve pressure values.
+
+        Arg:
+            * field: the name of a Rep field, as described by the
+              `Param` list of the response.
+
+        Keyword arg:
+            * dtype: if specified, the values are converted to a numpy array
+              of this dtype (for example, 'float32'); otherwise (default) a
+              list of the values as given in the response is returned.
+
+        :Note:
+
+            If the response has not already been parsed and msgspec or
+            simdjson is available, the raw response is decoded selectively,
+            so that only the requested values are converted to Python
+            objects.
+
+        """
+        if dtype is not None:
+            # numpy is only imported when needed, as it is slow to import.
+            try:
+                import numpy as np
+            except ImportError:
+                raise ImportError('numpy is required to return values as an '
+                                  'array of dtype {}'.format(dtype))
+
+        values = None
+        if self.data is None and self.response is not None and msgspec:
+            try:
+                site_rep = msgspec.json.decode(
+                    self.response, type=self._site_rep_type(field)).SiteRep
+            except msgspec.ValidationError:
+                # Let the parsed response raise the same error (for example,
+                # a KeyError for a missing field) as the other paths would.
+                pass
+            else:
+                values = [rep.value for period in site_rep.DV.Location.Period
+                          for rep in period.Rep]
+        elif self.data is None and self.response is not None and simdjson:
+            values = self._lazy_rep_values(field)
+        if values is None:
+            periods = self.parse_response()['SiteRep']['DV']['Location'][
+                'Period']
+            values = [rep[field] for period in periods
+                      for rep in period['Rep']]
+
+        if dtype is not None:
+            # DataPoint gives numeric values as strings; numpy converts these
+            # directly into a preallocated array.
+            values = np.fromiter(values, dtype=dtype, count=len(values))
+        return values
+
+    @classmethod
+    def _site_rep_type(cls, field):
+        """
+        Returns a msgspec type describing a SiteRep response down to the
+        `field` of each Rep, so that all other fields are skipped in decoding.
+
+        """
+        root = cls._site_rep_types.get(field)
+        if root is None:
+            rep = msgspec.defstruct('Rep', [('value', Any)],
+                                    rename={'value': field})
+            period = msgspec.defstruct('Period', [('Rep', List[rep])])
+            location = msgspec.defstruct('Location',
+                                         [('Period', List[period])])
+            dv = msgspec.defstruct('DV', [('Location', location)])
+            site_rep = msgspec.defstruct('SiteRep', [('DV', dv)])
+            root = msgspec.defstruct('Root', [('SiteRep', site_rep)])
+            cls._site_rep_types[field] = root
+        return root
+
+    def _lazy_rep_values(self, field):
+        """
+        Uses simdjson to retrieve the values of `field` from the raw response,
+        converting only those values to Python objects.
+
+        """
+        parser = getattr(self._parsers, 'parser', None)
+        if parser is None:
+            parser = self._parsers.parser = simdjson.Parser()
+        # A parser may only be reused once no part of its previous document
+        # is referenced, so nothing from `periods` outlives this call.
+        periods = parser.parse(self.response).at_pointer(
+            '/SiteRep/DV/Location/Period')
+        return [rep[field] for period in periods for rep in period['Rep']]
+
+
+def fetch_many(dp_requests, concurrency=16, use_cache=True):
+    """
+    Sends a number of DataPoint requests concurrently, sharing the pooled
+    connections of the :class:`DPRequest` HTTP session.
+
+    Args:
+        * dp_requests: an iterable of :class:`DPRequest` instances, each with
+          its request string already built (see :func:DPRequest.build_request).
+
+    Keyword args:
+        * concurrency: the maximum number of requests in flight at once.
+        * use_cache: if False, bypass the response cache (see
+          :func:DPRequest.build_request).
+
+    Returns the list of DPRequest instances, each with its response set.
+
+    """
+    dp_requests = list(dp_requests)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Consume the results so that any request errors are raised here.
+        list(executor.map(
+            lambda dp_request: dp_request._request(use_cache=use_cache),
+            dp_requests))
+    return dp_requests
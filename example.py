@@ -1,19 +1,19 @@
 import datapoint_access as dpa
 
-api_key = str(raw_input('Please enter a valid API Key: '))
+api_key = input('Please enter a valid API Key: ')
 
-url1 = dpa.DPRequest('val', 'wxobs', api_key, site_id=3772, res='hourly')
+url1 = dpa.DPRequest('val', 'wxobs', api_key, site_id=3772, res='hourly',
+                     verbose=True)
 url1.build_request()
-data1 = url1.parse_response()
 
-print('Response {}\n'.format(url1.response))
-print('Parsed data: {}\n'.format(data1))
+print('Response {}\n'.format(url1.response.decode('utf-8')))
 
-# As can be seen, actually getting to the numbers can prove interesting:
-numbers = data1['SiteRep']['DV']['Location']['Period']
-pressure = []
-for number in numbers:
-    itms = number['Rep']
-    for itm in itms:
-        pressure.append(itm['P'])
+# Actually getting to the numbers in the response can prove interesting, so
+# `rep_values` retrieves a single field from every observation, here as a
+# numpy array of floats:
+pressure = url1.rep_values('P', dtype='float32')
 print('Retrieved pressure data:\n{}'.format(pressure))
+
+# The whole response can also be parsed into Pythonic data structures:
+data1 = url1.parse_response()
+print('Parsed data: {}\n'.format(data1))